@@ -0,0 +1,106 @@
+"""Deterministic synthetic inputs for the benchmark suite."""
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+SIZES = (10, 100, 1000)
+ORIGIN = datetime(2025, 6, 1, 12, 0, tzinfo=timezone.utc)
+_LONDON = ZoneInfo("Europe/London")
+
+
+def _dispatch(start, minutes):
+    return {"start": start, "end": start + timedelta(minutes=minutes), "source": "smart-charge"}
+
+
+def scattered(n, seed=1):
+    """Short dispatches spread over two days, mostly disjoint."""
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        start = ORIGIN + timedelta(minutes=rnd.randrange(0, 2 * 1440), seconds=rnd.choice((0, 0, 30)))
+        out.append(_dispatch(start, rnd.randrange(5, 90)))
+    return out
+
+
+def overlapping(n, seed=2):
+    """Pathological: every dispatch overlaps a common 3-hour stretch."""
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        start = ORIGIN + timedelta(hours=2, minutes=rnd.randrange(0, 120))
+        out.append(_dispatch(start, rnd.randrange(30, 180)))
+    return out
+
+
+def chained(n, seed=3):
+    """Pathological: back-to-back dispatches in reverse order, forming one long merge chain."""
+    out = []
+    for i in range(n):
+        out.append(_dispatch(ORIGIN + timedelta(minutes=30 * i), 30))
+    out.reverse()
+    return out
+
+
+def core_heavy(n, seed=4):
+    """Dispatches clustered around the 23:30-05:30 core window so core extension iterates."""
+    rnd = random.Random(seed)
+    core = ORIGIN.replace(hour=23, minute=30)
+    out = []
+    for _ in range(n):
+        start = core + timedelta(minutes=rnd.randrange(-360, 720))
+        out.append(_dispatch(start, rnd.randrange(15, 120)))
+    return out
+
+
+def multi_day(n, seed=5):
+    """Long horizon: dispatches over two weeks."""
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        start = ORIGIN + timedelta(minutes=30 * rnd.randrange(0, 14 * 48))
+        out.append(_dispatch(start, rnd.randrange(10, 150)))
+    return out
+
+
+def randomized(rnd, tz=None):
+    """A random dispatch set for equivalence checks: odd seconds, zero-length and overlapping
+    dispatches, fixed-offset and DST zones, 1-40 dispatches over two days."""
+    if tz is None:
+        tz = rnd.choice((timezone.utc, timezone(timedelta(hours=5, minutes=45)), _LONDON))
+    origin = datetime(2025, rnd.choice((3, 6, 10)), rnd.choice((15, 26, 29, 30)), rnd.randrange(24), tzinfo=tz)
+    out = []
+    for _ in range(rnd.randrange(1, 40)):
+        start = origin + timedelta(minutes=rnd.randrange(-600, 2 * 1440), seconds=rnd.choice((0, 0, 17, 30)))
+        out.append(_dispatch(start, rnd.randrange(0, 240)))
+    return out
+
+
+PATTERNS = {
+    "scattered": scattered,
+    "overlapping": overlapping,
+    "chained": chained,
+    "core_heavy": core_heavy,
+    "multi_day": multi_day,
+}
+
+
+def charge_windows(count):
+    """ChargeWindow fields: charge start/end, discharge start/end (minute of day), currents."""
+    out = []
+    for i in range(count):
+        out.append((((i * 3) % 24) * 60, ((i * 3 + 1) % 24) * 60 + 30, 0, 0, 60, 100))
+    return out
+
+
+def inverter_list_text(records, trailing_commas=True):
+    """An inverterList response body; SolisCloud sometimes emits trailing commas."""
+    rows = []
+    for i in range(records):
+        rows.append({"id": str(1000 + i), "sn": f"SN{i:06d}", "stationName": f"Plant \"{i}\", roof",
+                     "productModel": "2", "state": 1, "power": 3.6})
+    text = json.dumps({"success": True, "code": "0", "msg": "success",
+                       "data": {"page": {"records": rows, "total": records}}})
+    if trailing_commas:
+        text = text.replace("}]", "},]").replace("}}", "},}")
+    return text
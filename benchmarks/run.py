@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""Benchmark the planning and request-signing hot paths.
+
+    python benchmarks/run.py                 # run, compare against the saved baseline if any
+    python benchmarks/run.py --save          # run and store the results as the new baseline
+    python benchmarks/run.py -k normalize    # only benchmarks whose name contains "normalize"
+    python benchmarks/run.py --verify 2000   # check optimised paths against the reference ones
+
+Each benchmark reports the median time per call over --repeat rounds. With a baseline
+present, any benchmark slower than baseline * (1 + --threshold) is a regression and the
+exit status is 1. Baselines are machine specific, so keep them local (see .gitignore).
+
+--verify runs randomized equivalence checks instead of timings: every planning engine must
+produce exactly the classic engine's windows and fit, and plan_windows (cache hits and
+incrementally patched merges) must match planning from scratch. Any mismatch is printed and
+the exit status is 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "tools"))
+
+from pyscript_loader import load_script  # noqa: E402
+
+import generators  # noqa: E402
+
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+CONFIG = {"secret": "benchmark-secret", "key_id": "1300386381676", "username": "u", "password": "p"}
+
+
+class _Response:
+    def __init__(self, text):
+        self._text = text
+
+    async def text(self):
+        return self._text
+
+
+def measure(prepare, func, number, repeat):
+    """Median seconds per call. prepare() builds one fresh input per call, outside the timing."""
+    samples = []
+    for _ in range(repeat):
+        inputs = []
+        for _ in range(number):
+            inputs.append(prepare())
+        start = time.perf_counter()
+        for item in inputs:
+            func(item)
+        samples.append((time.perf_counter() - start) / number)
+    return statistics.median(samples)
+
+
+def calls_for(size):
+    # Keep large inputs to a few calls per round so the classic O(n^2) sort stays bounded
+    return max(1, 2000 // size)
+
+
+def planning_benchmarks(script):
+    cases = []
+    for pattern, make in generators.PATTERNS.items():
+        for size in generators.SIZES:
+            dispatches = make(size)
+            number = calls_for(size)
+
+            for engine in script.PLANNING_ENGINES:
+                def prepare_normalize(engine=engine, dispatches=dispatches):
+                    copies = []
+                    for d in dispatches:
+                        copies.append(dict(d))
+                    return script.window_processor(engine, 6), copies
+
+                cases.append((f"normalize_dispatches[{engine}]/{pattern}/{size}", prepare_normalize,
+                              lambda item: item[0].normalize_dispatches(item[1]), number))
+
+                def prepare_planned(engine=engine, dispatches=dispatches):
+                    processor = script.window_processor(engine, 6)
+                    processor.normalize_dispatches(list(dispatches))
+                    return processor
+
+                cases.append((f"process_core_hours[{engine}]/{pattern}/{size}", prepare_planned,
+                              lambda processor: processor.process_core_hours(), number))
+
+                settings = {"planning_engine": engine, "slot_strategy": "longest", "gap_cost": 1.0}
+
+                def prepare_hit(settings=settings, dispatches=dispatches):
+                    script.plan_windows(settings, 6, dispatches, "benchmark")
+                    return dispatches
+
+                cases.append((f"plan_windows[{engine},hit]/{pattern}/{size}", prepare_hit,
+                              lambda d, settings=settings: script.plan_windows(settings, 6, d, "benchmark"), number))
+
+                def prepare_patch(settings=settings, dispatches=dispatches):
+                    # Cached base for the set, then a miss for the set plus three new dispatches
+                    script._plan_cache.clear()
+                    script.plan_windows(settings, 6, dispatches, "benchmark")
+                    script._plan_cache.clear()
+                    return dispatches + generators.scattered(3, seed=size)
+
+                cases.append((f"plan_windows[{engine},patch]/{pattern}/{size}", prepare_patch,
+                              lambda d, settings=settings: script.plan_windows(settings, 6, d, "benchmark"), number))
+
+            def prepare_selected(dispatches=dispatches):
+                processor = script.WindowProcessor(6)
+                processor.normalize_dispatches(list(dispatches))
+                processor.process_core_hours()
+                return processor
+
+            cases.append((f"select_additional_windows/{pattern}/{size}", prepare_selected,
+                          lambda processor: processor.select_additional_windows(), number))
+            for strategy in ("min_dropped", "min_cost"):
+                if size <= 100:
+                    cases.append((f"fit_additional_windows[{strategy}]/{pattern}/{size}", prepare_selected,
+                                  lambda processor, s=strategy: processor.fit_additional_windows(s, 1.0),
+                                  max(1, number // 10)))
+
+    def prepare_format():
+        processor = script.WindowProcessor(6)
+        processor.normalize_dispatches(generators.scattered(10))
+        processor.process_core_hours()
+        return processor, processor.select_additional_windows()
+
+    cases.append(("format_windows/6", prepare_format, lambda item: item[0].format_windows(item[1]), 500))
+    return cases
+
+
+def io_benchmarks(script):
+    cases = []
+    for size in (64, 1024, 16384):
+        body = json.dumps({"pageNo": 1, "pageSize": 100, "padding": "x" * size})
+        cases.append((f"prepare_header/{size}B", lambda body=body: body,
+                      lambda body: script.prepare_header(CONFIG, body, script.CONTROL_URL), 2000))
+
+    at_read_bodies = []
+    for cid in script.CHARGE_TIME_CIDS + script.CHARGE_CURRENT_CIDS + script.CHARGE_SOC_CIDS:
+        at_read_bodies.append(json.dumps({"inverterSn": "SN000001", "cid": cid}, separators=(",", ":")))
+
+    def sign_burst(bodies):
+        # A bulk CID read signs each request as it is sent, like solis_post
+        for body in bodies:
+            script.prepare_header(CONFIG, body, script.AT_READ_URL)
+
+    cases.append((f"prepare_header/burst{len(at_read_bodies)}", lambda: at_read_bodies, sign_burst, 200))
+
+    windows = []
+    for fields in generators.charge_windows(6):
+        windows.append(script.ChargeWindow(*fields))
+    cases.append(("legacy_control_body/3", lambda: windows[:3],
+                  lambda w: script.legacy_control_body("1308675217948233", w), 5000))
+    cases.append(("window_attributes/6", lambda: windows,
+                  script.window_attributes, 5000))
+    cases.append(("schedule_fingerprint/6", lambda: windows,
+                  lambda w: script.schedule_fingerprint(w, "legacy", {}), 5000))
+
+    loop = asyncio.new_event_loop()
+    for records in (1, 20, 500):
+        for trailing in (False, True):
+            text = generators.inverter_list_text(records, trailing)
+            label = "trailing" if trailing else "clean"
+            number = max(5, 2000 // records)
+            cases.append((f"_clean_json_text/{records}rec/{label}", lambda text=text: text,
+                          script._clean_json_text, number))
+            cases.append((f"resp_json/{records}rec/{label}", lambda text=text: _Response(text),
+                          lambda resp: loop.run_until_complete(script.resp_json(resp)), number))
+    return cases
+
+
+def _plan(script, engine, max_slots, strategy, dispatches):
+    processor = script.window_processor(engine, max_slots)
+    processor.normalize_dispatches([dict(d) for d in dispatches])
+    processor.process_core_hours()
+    additional = processor.fit_additional_windows(strategy, 1.0)
+    return processor.format_windows(additional), round(processor.dropped_minutes, 1), round(processor.gap_minutes, 1)
+
+
+def verify_engines(script, cases):
+    """Every planning engine against the classic one, for random dispatch sets and strategies.
+    The bitmap engine is checked twice: as configured (small sets use the classic core step)
+    and with its bitmap core step forced on."""
+    mismatches = []
+    min_blocks = script.SlotBitmapProcessor.core_min_blocks
+    for seed in range(cases):
+        rnd = random.Random(seed)
+        dispatches = generators.randomized(rnd)
+        max_slots = rnd.choice((3, 6))
+        strategy = rnd.choice(script.SLOT_STRATEGIES)
+        want = _plan(script, "classic", max_slots, strategy, dispatches)
+        for engine in script.PLANNING_ENGINES:
+            if engine != "classic" and _plan(script, engine, max_slots, strategy, dispatches) != want:
+                mismatches.append(f"engine {engine} seed={seed} slots={max_slots} strategy={strategy}")
+        script.SlotBitmapProcessor.core_min_blocks = 0
+        try:
+            if _plan(script, "bitmap", max_slots, strategy, dispatches) != want:
+                mismatches.append(f"engine bitmap (bitmap core) seed={seed} slots={max_slots} strategy={strategy}")
+        finally:
+            script.SlotBitmapProcessor.core_min_blocks = min_blocks
+    return mismatches
+
+
+def verify_plan_cache(script, cases):
+    """plan_windows against a fresh plan: a dispatch set, then the same set with dispatches
+    added, removed or reordered (cache patch or hit) under the same key, then a copy of that
+    (raw fingerprint hit)."""
+    mismatches = []
+    for seed in range(cases):
+        rnd = random.Random(seed)
+        settings = {"planning_engine": rnd.choice(script.PLANNING_ENGINES),
+                    "slot_strategy": rnd.choice(script.SLOT_STRATEGIES), "gap_cost": 1.0}
+        max_slots = rnd.choice((3, 6))
+        dispatches = generators.randomized(rnd)
+        changed = list(dispatches)
+        op = rnd.random()
+        if op < 0.4:
+            # Usually from the same sensor (same zone); sometimes mixed zones, which bypass the cache
+            tz = dispatches[0]["start"].tzinfo if rnd.random() < 0.8 else None
+            changed += generators.randomized(rnd, tz)[:rnd.randrange(1, 4)]
+        elif op < 0.8 and len(changed) > 1:
+            for _ in range(rnd.randrange(1, min(4, len(changed)))):
+                changed.pop(rnd.randrange(len(changed)))
+        elif op < 0.9:
+            rnd.shuffle(changed)
+
+        # A few keys shared between seeds, so some first plans also patch an unrelated base
+        key = f"verify{seed % 3}"
+        for step, current in enumerate((dispatches, changed, [dict(d) for d in changed])):
+            got = script.plan_windows(settings, max_slots, current, key)
+            windows, dropped, gap = _plan(script, settings["planning_engine"], max_slots,
+                                          settings["slot_strategy"], current)
+            want = (windows, {"strategy": settings["slot_strategy"], "dropped_minutes": dropped,
+                              "gap_minutes": gap})
+            if got != want:
+                mismatches.append(f"plan_windows seed={seed} step={step} {settings} slots={max_slots}")
+    return mismatches
+
+
+def verify(args):
+    script = load_script()
+    checks = (("planning engines", verify_engines), ("plan cache", verify_plan_cache))
+    failed = 0
+    for label, check in checks:
+        mismatches = check(script, args.verify)
+        print(f"{label:<24} {args.verify} cases, {len(mismatches)} mismatches")
+        for line in mismatches[:10]:
+            print(f"  {line}")
+        failed += len(mismatches)
+    return 1 if failed else 0
+
+
+def run(args):
+    script = load_script()
+    cases = planning_benchmarks(script) + io_benchmarks(script)
+    results = {}
+    for name, prepare, func, number in cases:
+        if args.filter and args.filter not in name:
+            continue
+        if args.quick:
+            number = max(1, number // 10)
+        seconds = measure(prepare, func, number, args.repeat)
+        results[name] = seconds
+        print(f"{name:<58} {seconds * 1e6:>12.2f} us")
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        ratio = seconds / before if before else 1.0
+        if ratio > 1 + threshold:
+            regressions.append((name, before, seconds, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--filter", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=5, help="timing rounds per benchmark (median is kept)")
+    parser.add_argument("--quick", action="store_true", help="10x fewer calls per round")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown vs baseline before failing (0.25 = 25%%)")
+    parser.add_argument("--verify", type=int, metavar="CASES",
+                        help="run CASES randomized equivalence checks instead of timings")
+    args = parser.parse_args(argv)
+
+    if args.verify:
+        return verify(args)
+
+    results = run(args)
+
+    if args.save:
+        existing = {}
+        if os.path.exists(args.baseline) and args.filter:
+            with open(args.baseline, encoding="utf-8") as f:
+                existing = json.load(f).get("results", {})
+        existing.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "results": existing}, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} results to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --save to create one")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("python") != platform.python_version():
+        print(f"Note: baseline was recorded on Python {baseline.get('python')}")
+
+    regressions = compare(results, baseline.get("results", {}), args.threshold)
+    if not regressions:
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+        return 0
+    print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+    for name, before, after, ratio in regressions:
+        print(f"  {name:<56} {before * 1e6:>10.2f} -> {after * 1e6:>10.2f} us  ({ratio:.2f}x)")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Replay recorded planned_dispatches snapshots through the window planner.
+
+Input is JSONL, one snapshot per line, in any of these shapes (HA history exports work):
+    {"planned_dispatches": [{"start": "...", "end": "..."}, ...]}
+    {"attributes": {"planned_dispatches": [...]}, "last_changed": "..."}
+    [ {...}, {...} ]                      (a list of the above on one line)
+
+Every snapshot is planned for each combination of --slots / --strategy / --engine, then
+coverage, dropped minutes, peak gap minutes and schedule churn are computed with NumPy
+over (snapshots x 1440) minute-of-day masks.
+
+    python tools/backtest.py history.jsonl --slots 3 6 --strategy longest min_dropped min_cost
+"""
+import argparse
+import itertools
+import json
+import sys
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - tool dependency only
+    sys.exit("backtest.py needs NumPy: pip install numpy")
+
+from pyscript_loader import load_script
+
+MINUTES_PER_DAY = 1440
+
+
+def parse_time(value, tz):
+    dt = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(tz) if tz is not None else dt
+
+
+def iter_snapshots(path, tz):
+    """Yield one list of {"start", "end"} dispatches per recorded snapshot."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            records = record if isinstance(record, list) else [record]
+            for item in records:
+                attrs = item.get("attributes", item)
+                raw = attrs.get("planned_dispatches")
+                if raw is None:
+                    continue
+                dispatches = []
+                for d in raw:
+                    dispatches.append({"start": parse_time(d["start"], tz), "end": parse_time(d["end"], tz)})
+                yield dispatches
+
+
+def minute_of_day(dt):
+    return dt.hour * 60 + dt.minute
+
+
+def hhmm_minutes(text):
+    hours, minutes = text.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def interval_masks(rows, starts, ends, n_rows):
+    """Boolean (n_rows, 1440) masks from minute-of-day intervals; end < start wraps past midnight."""
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    keep = starts != ends
+    rows, starts, ends = rows[keep], starts[keep], ends[keep]
+
+    wraps = ends < starts
+    # Split wrapping intervals into [start, 1440) and [0, end)
+    seg_rows = np.concatenate([rows, rows[wraps]])
+    seg_starts = np.concatenate([starts, np.zeros(wraps.sum(), dtype=np.int64)])
+    seg_ends = np.concatenate([np.where(wraps, MINUTES_PER_DAY, ends), ends[wraps]])
+
+    # Difference array + cumulative sum: +1 at start, -1 at end, covered where count > 0
+    diff = np.zeros((n_rows, MINUTES_PER_DAY + 1), dtype=np.int32)
+    np.add.at(diff, (seg_rows, seg_starts), 1)
+    np.add.at(diff, (seg_rows, seg_ends), -1)
+    return np.cumsum(diff[:, :MINUTES_PER_DAY], axis=1) > 0
+
+
+def dispatch_masks(snapshots):
+    rows, starts, ends = [], [], []
+    for row, dispatches in enumerate(snapshots):
+        for d in dispatches:
+            span = (d["end"] - d["start"]).total_seconds() / 60
+            if span <= 0:
+                continue
+            rows.append(row)
+            if span >= MINUTES_PER_DAY:
+                starts.append(0)
+                ends.append(MINUTES_PER_DAY)
+            else:
+                starts.append(minute_of_day(d["start"]))
+                ends.append(minute_of_day(d["end"]))
+    return interval_masks(rows, starts, ends, len(snapshots))
+
+
+def plan_snapshots(script, snapshots, max_slots, strategy, engine, gap_cost, core):
+    """Planner output per snapshot: list of (start, end) minute-of-day windows. Repeated
+    snapshots (the sensor re-reports unchanged dispatches) are planned once."""
+    memo = {}
+    planned = []
+    for dispatches in snapshots:
+        key = tuple((d["start"], d["end"]) for d in dispatches)
+        if key not in memo:
+            processor = script.window_processor(engine, max_slots, core[0], core[1])
+            if dispatches:
+                processor.normalize_dispatches([dict(d) for d in dispatches])
+                processor.process_core_hours()
+                additional = processor.fit_additional_windows(strategy, gap_cost)
+            else:
+                additional = []
+            windows = []
+            for w in processor.format_windows(additional):
+                if script.window_active(w):
+                    windows.append((w.charge_start, w.charge_end))
+            memo[key] = windows
+        planned.append(memo[key])
+    return planned
+
+
+def score(planned, dispatch_mask, core_mask):
+    rows, starts, ends = [], [], []
+    for row, windows in enumerate(planned):
+        for start, end in windows:
+            rows.append(row)
+            starts.append(start)
+            ends.append(end)
+    schedule = interval_masks(rows, starts, ends, len(planned))
+
+    dispatch_minutes = int(dispatch_mask.sum())
+    covered = int((dispatch_mask & schedule).sum())
+    gap = int((schedule & ~dispatch_mask & ~core_mask).sum())
+    changes = int(np.any(schedule[1:] != schedule[:-1], axis=1).sum()) if len(planned) > 1 else 0
+    return {
+        "dispatch_minutes": dispatch_minutes,
+        "covered_minutes": covered,
+        "coverage": round(covered / dispatch_minutes, 4) if dispatch_minutes else 1.0,
+        "dropped_minutes": dispatch_minutes - covered,
+        "gap_minutes": gap,
+        "schedule_changes": changes,
+        "churn": round(changes / (len(planned) - 1), 4) if len(planned) > 1 else 0.0,
+    }
+
+
+def run(args):
+    tz = None
+    if args.timezone:
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo(args.timezone)
+
+    script = load_script()
+    snapshots = list(iter_snapshots(args.history, tz))
+    if not snapshots:
+        sys.exit(f"No planned_dispatches snapshots found in {args.history}")
+
+    core = tuple(args.core.split("-"))
+    dispatch_mask = dispatch_masks(snapshots)
+    core_mask = interval_masks([0], [hhmm_minutes(core[0])], [hhmm_minutes(core[1])], 1)
+
+    results = []
+    for max_slots, strategy, engine in itertools.product(args.slots, args.strategy, args.engine):
+        planned = plan_snapshots(script, snapshots, max_slots, strategy, engine, args.gap_cost, core)
+        result = {"max_slots": max_slots, "strategy": strategy, "engine": engine, "snapshots": len(snapshots)}
+        result.update(score(planned, dispatch_mask, core_mask))
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("history", help="JSONL file of planned_dispatches snapshots")
+    parser.add_argument("--slots", type=int, nargs="+", default=[3, 6], help="max_slots values to replay")
+    parser.add_argument("--strategy", nargs="+", default=["longest"], help="slot_strategy values to replay")
+    parser.add_argument("--engine", nargs="+", default=["classic"], help="planning_engine values to replay")
+    parser.add_argument("--gap-cost", type=float, default=1.0, help="gap_cost for the min_cost strategy")
+    parser.add_argument("--core", default="23:30-05:30", help="core window as HH:MM-HH:MM")
+    parser.add_argument("--timezone", help="convert dispatch times to this IANA zone before planning")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    header = ("slots", "strategy", "engine", "coverage", "dropped", "gap", "changes", "churn")
+    print("{:>5}  {:<12} {:<8} {:>8} {:>8} {:>6} {:>7} {:>6}".format(*header))
+    for r in results:
+        print("{:>5}  {:<12} {:<8} {:>7.1%} {:>8} {:>6} {:>7} {:>6.1%}".format(
+            r["max_slots"], r["strategy"], r["engine"], r["coverage"], r["dropped_minutes"],
+            r["gap_minutes"], r["schedule_changes"], r["churn"]))
+    print(f"{results[0]['snapshots']} snapshots, {results[0]['dispatch_minutes']} dispatch minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Load solis_smart_charging.py outside Home Assistant for offline tooling.
+
+The script is written for pyscript: it relies on injected decorators (@service,
+@pyscript_compile, ...) and globals (hass, state, task, log). This loader execs it
+with pass-through decorators and inert globals so the pure planning code
+(WindowProcessor, SlotBitmapProcessor, _fit_slots, prepare_header, ...) can be used
+from plain Python. Nothing that talks to Home Assistant or SolisCloud is usable.
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+import sys
+import types
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "solis_smart_charging.py")
+
+
+def _passthrough(*args, **kwargs):
+    # Supports both @decorator and @decorator("arg") forms
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return lambda func: func
+
+
+def _ensure_homeassistant():
+    if "homeassistant" in sys.modules or importlib.util.find_spec("homeassistant") is not None:
+        return
+    ha = types.ModuleType("homeassistant")
+    helpers = types.ModuleType("homeassistant.helpers")
+    client = types.ModuleType("homeassistant.helpers.aiohttp_client")
+
+    def async_get_clientsession(hass):
+        raise RuntimeError("No Home Assistant session available offline")
+
+    client.async_get_clientsession = async_get_clientsession
+    sys.modules.setdefault("homeassistant", ha)
+    sys.modules.setdefault("homeassistant.helpers", helpers)
+    sys.modules.setdefault("homeassistant.helpers.aiohttp_client", client)
+
+
+class _Task:
+    def create(self, func, *args, **kwargs):
+        return asyncio.ensure_future(func(*args, **kwargs))
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+def load_script(path=SCRIPT_PATH, log_level=logging.WARNING):
+    """Exec the pyscript file and return its globals as a namespace."""
+    _ensure_homeassistant()
+    namespace = {
+        "__name__": "solis_smart_charging",
+        "service": _passthrough,
+        "pyscript_compile": _passthrough,
+        "pyscript_executor": _passthrough,
+        "time_trigger": _passthrough,
+        "state_trigger": _passthrough,
+        "hass": None,
+        "state": None,
+        "task": _Task(),
+        "pyscript": types.SimpleNamespace(config={"apps": {}}, app_config={}),
+    }
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    exec(compile(source, path, "exec"), namespace)
+    namespace["log"].setLevel(log_level)
+    return types.SimpleNamespace(**namespace)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Local SolisCloud stand-in for load, latency and retry testing.
+
+Implements the endpoints the script uses (login, control, atRead, inverterList,
+inverterDetail), checks the HMAC Authorization / Content-MD5 / Date headers the same way
+SolisCloud does, and keeps per-inverter CID state (CID 103 and the six-slot CIDs). CID 56
+is a running inverter clock: reads return its current time, writes set it.
+
+    python tools/solis_simulator.py --port 13333 --latency 0.3 --error-rate 0.05 --rate-limit 5
+
+Point the script at it with "base_url": "http://127.0.0.1:13333" (and a separate
+"cache_path" so simulated tokens and CID values don't mix with the real ones).
+
+GET  /_sim/stats   request counts, status counts and latency per endpoint, plus CID state
+POST /_sim/reset   clear counters, tokens and CID state
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import random
+import secrets
+import time
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from zoneinfo import ZoneInfo
+
+from aiohttp import web
+
+SIX_SLOT_DEFAULTS = {
+    # charge / discharge times
+    "5946": "00:00-00:00", "5949": "00:00-00:00", "5952": "00:00-00:00",
+    "5955": "00:00-00:00", "5958": "00:00-00:00", "5961": "00:00-00:00",
+    "5964": "00:00-00:00", "5968": "00:00-00:00", "5972": "00:00-00:00",
+    "5976": "00:00-00:00", "5980": "00:00-00:00", "5987": "00:00-00:00",
+    # charge / discharge currents
+    "5948": "0", "5951": "0", "5954": "0", "5957": "0", "5960": "0", "5963": "0",
+    "5967": "0", "5971": "0", "5975": "0", "5979": "0", "5983": "0", "5986": "0",
+    # charge / discharge SOCs
+    "5928": "100", "5929": "100", "5930": "100", "5931": "100", "5932": "100", "5933": "100",
+    "5965": "10", "5969": "10", "5973": "10", "5977": "10", "5981": "10", "5984": "10",
+}
+CLOCK_FORMAT = "%Y-%m-%d %H:%M:%S"
+LEGACY_DEFAULT = "0,0,00:00,00:00,00:00,00:00,0,0,00:00,00:00,00:00,00:00,0,0,00:00,00:00,00:00,00:00"
+
+
+class Simulator:
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.tokens = {}
+        self.zone = ZoneInfo(args.timezone)
+        self.inverters = []
+        for i in range(args.inverters):
+            sn = f"{args.sn_prefix}{i + 1:04d}"
+            self.inverters.append({
+                "id": str(1308675217948000 + i),
+                "sn": sn,
+                "name": f"Simulated inverter {i + 1}",
+                "productModel": "2",
+                "hmi": args.hmi,
+                "cids": dict(SIX_SLOT_DEFAULTS, **{"103": LEGACY_DEFAULT, "56": ""}),
+                "clock_offset": args.clock_drift,
+            })
+        self.bucket = [float(args.rate_burst), time.monotonic()]
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {}
+
+    def record(self, path, status, seconds):
+        entry = self.stats.setdefault(path, {"requests": 0, "statuses": {}, "seconds": 0.0, "max_seconds": 0.0})
+        entry["requests"] += 1
+        entry["statuses"][str(status)] = entry["statuses"].get(str(status), 0) + 1
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def find(self, sn=None, inverter_id=None):
+        for inv in self.inverters:
+            if (sn and inv["sn"] == str(sn)) or (inverter_id and inv["id"] == str(inverter_id)):
+                return inv
+        return None
+
+    # --- quirks ---------------------------------------------------------------
+    def rate_limited(self):
+        if self.args.rate_limit <= 0:
+            return False
+        tokens, last = self.bucket
+        now = time.monotonic()
+        tokens = min(float(self.args.rate_burst), tokens + (now - last) * self.args.rate_limit)
+        if tokens < 1:
+            self.bucket = [tokens, now]
+            return True
+        self.bucket = [tokens - 1, now]
+        return False
+
+    def clock(self, inv):
+        now = datetime.now(self.zone).replace(tzinfo=None)
+        return (now + timedelta(seconds=inv["clock_offset"])).strftime(CLOCK_FORMAT)
+
+    def set_clock(self, inv, value):
+        now = datetime.now(self.zone).replace(tzinfo=None)
+        inv["clock_offset"] = (datetime.strptime(value, CLOCK_FORMAT) - now).total_seconds()
+
+    def body_text(self, payload):
+        text = json.dumps(payload)
+        if self.rnd.random() < self.args.trailing_commas:
+            text = text.replace("}", ",}").replace("{,}", "{}").replace("]", ",]").replace("[,]", "[]")
+        return text
+
+    def reply(self, payload, status=200):
+        return web.Response(text=self.body_text(payload), status=status, content_type="application/json")
+
+    # --- auth -----------------------------------------------------------------
+    def signature_error(self, request, body):
+        content_md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+        if request.headers.get("Content-MD5") != content_md5:
+            return "Content-MD5 mismatch"
+        date = request.headers.get("Date", "")
+        try:
+            skew = abs(time.time() - parsedate_to_datetime(date).timestamp())
+        except (TypeError, ValueError):
+            return "Bad Date header"
+        if skew > self.args.max_skew:
+            return f"Date skew {skew:.0f}s"
+        to_sign = "\n".join(("POST", content_md5, request.headers.get("Content-Type", ""), date, request.path))
+        sign = base64.b64encode(hmac.new(self.args.secret.encode(), to_sign.encode(), hashlib.sha1).digest()).decode()
+        if request.headers.get("Authorization") != f"API {self.args.key_id}:{sign}":
+            return "Signature mismatch"
+        return None
+
+    def token_valid(self, request):
+        expires = self.tokens.get(request.headers.get("token", ""))
+        return expires is not None and expires > time.monotonic()
+
+    # --- handlers -------------------------------------------------------------
+    @web.middleware
+    async def middleware(self, request, handler):
+        started = time.monotonic()
+        response = await self.simulate(request, handler)
+        if not request.path.startswith("/_sim"):
+            self.record(request.path, response.status, time.monotonic() - started)
+        return response
+
+    async def simulate(self, request, handler):
+        if request.path.startswith("/_sim"):
+            return await handler(request)
+        delay = self.args.latency + self.rnd.uniform(0, self.args.jitter)
+        if self.rnd.random() < self.args.hang_rate:
+            delay += self.args.hang_seconds
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.rate_limited():
+            return self.reply({"success": False, "code": "429", "msg": "Too many requests"}, 429)
+        if self.rnd.random() < self.args.error_rate:
+            status = self.rnd.choice((500, 502, 503, 504))
+            return web.Response(text="Simulated upstream error", status=status)
+
+        body = await request.read()
+        error = self.signature_error(request, body)
+        if error:
+            return self.reply({"success": False, "code": "403", "msg": error}, 403)
+        try:
+            request["payload"] = json.loads(body or b"{}")
+        except ValueError:
+            return self.reply({"success": False, "code": "1", "msg": "Invalid JSON body"}, 400)
+        return await handler(request)
+
+    async def login(self, request):
+        payload = request["payload"]
+        password = hashlib.md5(self.args.password.encode()).hexdigest()
+        if payload.get("userInfo") != self.args.username or payload.get("password") != password:
+            return self.reply({"success": False, "code": "B0001", "msg": "Username or password error"})
+        token = secrets.token_hex(16)
+        self.tokens[token] = time.monotonic() + self.args.token_ttl
+        return self.reply({"success": True, "code": "0", "msg": "success", "csrfToken": token})
+
+    async def inverter_list(self, request):
+        records = []
+        for inv in self.inverters:
+            record = {"id": inv["id"], "sn": inv["sn"], "name": inv["name"], "productModel": inv["productModel"],
+                      "stationId": request["payload"].get("stationId")}
+            # Real records carry ~100 fields the script never reads
+            for i in range(self.args.record_padding):
+                record[f"field{i}"] = i * 1.5 if i % 3 else f"value {i}"
+            records.append(record)
+        page = {"records": records, "total": len(records), "current": 1, "size": 20}
+        return self.reply({"success": True, "code": "0", "msg": "success", "data": {"page": page}})
+
+    async def inverter_detail(self, request):
+        payload = request["payload"]
+        inv = self.find(payload.get("sn"), payload.get("id"))
+        if inv is None:
+            return self.reply({"success": False, "code": "1", "msg": "Inverter not found"})
+        return self.reply({"success": True, "code": "0", "msg": "success",
+                           "data": {"id": inv["id"], "sn": inv["sn"], "hmiVersionAll": inv["hmi"]}})
+
+    async def control(self, request):
+        if not self.token_valid(request):
+            return self.reply({"success": False, "code": "B0115", "msg": "token is invalid, please login again"})
+        payload = request["payload"]
+        inv = self.find(payload.get("inverterSn"), payload.get("inverterId"))
+        cid = str(payload.get("cid", ""))
+        if inv is None or cid not in inv["cids"]:
+            return self.reply({"success": True, "code": "0", "msg": "success",
+                               "data": [{"code": "1", "msg": "Unknown inverter or CID"}]})
+        if self.rnd.random() < self.args.reject_rate:
+            # Accepted by the cloud but the inverter didn't answer
+            return self.reply({"success": True, "code": "0", "msg": "success",
+                               "data": [{"code": "2", "msg": "Inverter offline"}]})
+        value = str(payload.get("value", ""))
+        if cid == "56":
+            try:
+                self.set_clock(inv, value)
+            except ValueError:
+                return self.reply({"success": True, "code": "0", "msg": "success",
+                                   "data": [{"code": "1", "msg": "Invalid time value"}]})
+        inv["cids"][cid] = value
+        return self.reply({"success": True, "code": "0", "msg": "success", "data": [{"code": "0", "msg": "success"}]})
+
+    async def at_read(self, request):
+        if not self.token_valid(request):
+            return self.reply({"success": False, "code": "B0115", "msg": "token is invalid, please login again"})
+        payload = request["payload"]
+        inv = self.find(payload.get("inverterSn"), payload.get("inverterId"))
+        cid = str(payload.get("cid", ""))
+        if inv is None or cid not in inv["cids"]:
+            return self.reply({"success": True, "code": "0", "msg": "success",
+                               "data": [{"code": "1", "msg": "Unknown inverter or CID"}]})
+        value = self.clock(inv) if cid == "56" else inv["cids"][cid]
+        return self.reply({"success": True, "code": "0", "msg": "success",
+                           "data": [{"code": "0", "msg": value}]})
+
+    async def stats_view(self, request):
+        state = {}
+        for inv in self.inverters:
+            state[inv["sn"]] = inv["cids"]
+        return web.json_response({"endpoints": self.stats, "cids": state})
+
+    async def reset_view(self, request):
+        self.__init__(self.args)
+        return web.json_response({"reset": True})
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_post("/v2/api/login", self.login)
+        app.router.add_post("/v2/api/control", self.control)
+        app.router.add_post("/v2/api/atRead", self.at_read)
+        app.router.add_post("/v1/api/inverterList", self.inverter_list)
+        app.router.add_post("/v1/api/inverterDetail", self.inverter_detail)
+        app.router.add_get("/_sim/stats", self.stats_view)
+        app.router.add_post("/_sim/reset", self.reset_view)
+        return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=13333)
+    parser.add_argument("--secret", default="simulator-secret", help="API secret the client must sign with")
+    parser.add_argument("--key-id", default="1300386381676")
+    parser.add_argument("--username", default="user@example.com")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--inverters", type=int, default=1, help="storage inverters in the plant")
+    parser.add_argument("--sn-prefix", default="SIM")
+    parser.add_argument("--hmi", default="4b05", help="hmiVersionAll reported by inverterDetail (4b00+ = six-slot)")
+    parser.add_argument("--latency", type=float, default=0.0, help="base seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform 0..jitter seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 5xx")
+    parser.add_argument("--reject-rate", type=float, default=0.0,
+                        help="fraction of control writes the inverter rejects (item code != 0)")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of requests delayed by --hang-seconds")
+    parser.add_argument("--hang-seconds", type=float, default=30.0)
+    parser.add_argument("--trailing-commas", type=float, default=0.0,
+                        help="fraction of responses with trailing commas added")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests/s before answering 429 (0 = off)")
+    parser.add_argument("--rate-burst", type=int, default=10)
+    parser.add_argument("--token-ttl", type=float, default=7200, help="seconds a csrfToken stays valid")
+    parser.add_argument("--clock-drift", type=float, default=0.0,
+                        help="initial seconds the inverter clock (CID 56) is ahead of real time")
+    parser.add_argument("--timezone", default="UTC", help="zone the inverter clock runs in")
+    parser.add_argument("--max-skew", type=float, default=900, help="allowed Date header skew in seconds")
+    parser.add_argument("--record-padding", type=int, default=100, help="unused fields per inverterList record")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    web.run_app(Simulator(args).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()